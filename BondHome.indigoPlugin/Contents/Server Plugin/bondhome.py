@@ -7,16 +7,32 @@ import logging
 import requests
 import socket
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
 PING_TIMEOUT = 60.0
+MAX_WORKERS = 8         # concurrent HTTP requests per bridge for bulk operations
+TRACE_SIZE = 200        # number of recent packets and requests kept in each bridge's trace buffer
+THREADDEBUG = 5         # Indigo's threaddebug log level
 
 
+# Returns (debug_enabled, threaddebug_enabled) for the plugin's configured log level.  Hot path debug messages are only
+# formatted when these are set.  The plugin log file handler accepts everything, so the logger's own level checks never
+# skip anything.
+def log_flags(log_level):
+    return log_level <= logging.DEBUG, log_level <= THREADDEBUG
+
+
+# sync_device_states() result for a device whose current state could not be read, as opposed to a failed PATCH
+class StateReadError(Exception):
+    pass
+
 
 ################################################################################
 class BondHome(object):
 
-    def __init__(self, address, token):
+    def __init__(self, address, token, log_level=logging.INFO):
         self.logger = logging.getLogger("Plugin.BondHome")
         self.address = address
         self.token_header = {'BOND-Token': token}
@@ -27,8 +43,15 @@ class BondHome(object):
         self.receive_thread = Thread(target=self.udp_receive)
         self.receive_thread.daemon = True
         self.next_ping = time.time()
+        self.trace = deque(maxlen=TRACE_SIZE)     # (timestamp, kind, detail, elapsed) for recent packets and requests
+        self.debug_enabled = False
+        self.threaddebug_enabled = False
+        self.set_log_level(log_level)
         self.logger.debug(f"BondHome __init__ address = {address}, token = {token}")
 
+    def set_log_level(self, log_level):
+        self.debug_enabled, self.threaddebug_enabled = log_flags(log_level)
+
     def __del__(self):
         if self.sock:
             self.sock.close()
@@ -62,14 +85,17 @@ class BondHome(object):
                 continue
             except socket.error as err:
                 raise
-            else:
+            # recorded in a finally so a packet that fails to parse or dispatch still shows up in the trace
+            start = time.time()
+            try:
                 data = json.loads(json_data.decode("utf-8"))
-
-            if topic := data.get('t'):
-                parts = topic.split('/')
-                if parts[0] == 'devices' and parts[2] == 'state':   # state update
-                    data['id'] = parts[1]
-                    self.callback(data)
+                if topic := data.get('t'):
+                    parts = topic.split('/')
+                    if parts[0] == 'devices' and parts[2] == 'state':   # state update
+                        data['id'] = parts[1]
+                        self.callback(data)
+            finally:
+                self.trace.append((start, "BPUP", json_data, time.time() - start))
 
     def udp_stop(self):
         self.enable_bpup(False)
@@ -82,42 +108,72 @@ class BondHome(object):
     # Commands to the Bridge
     ########################################
 
+    # all HTTP requests to the bridge go through here, so they're recorded in the trace buffer with their timings
+    def request(self, method, url, payload=None):
+        start = time.time()
+        status = None
+        try:
+            resp = requests.request(method, url, headers=self.token_header, json=payload)
+            status = resp.status_code
+        except Exception as err:
+            status = type(err).__name__     # failed requests are recorded too, in place of the status code
+            raise
+        finally:
+            self.trace.append((start, method, (url, payload, status), time.time() - start))
+        return resp
+
+    # formatting is done here, on demand, rather than when the entries are recorded
+    def get_trace(self):
+        retList = []
+        for timestamp, kind, detail, elapsed in list(self.trace):
+            if kind == "BPUP":
+                text = detail.decode("utf-8", errors="replace").strip()
+            else:
+                url, payload, status = detail
+                text = f"{url} {payload} -> {status}" if payload is not None else f"{url} -> {status}"
+            retList.append((timestamp, f"{self.address} {kind:5s} {elapsed * 1000.0:8.1f} ms  {text}"))
+        return retList
+
     def device_action(self, device_id, action, payload=None):
         url = f"http://{self.address}/v2/devices/{device_id}/actions/{action}"
-        self.logger.debug(f"device_action, url = {url}, payload = {payload}")
-        resp = requests.put(url, headers=self.token_header, json=payload)
+        if self.debug_enabled:
+            self.logger.debug(f"device_action, url = {url}, payload = {payload}")
+        resp = self.request("PUT", url, payload)
         if not resp.ok:
             self.logger.warning(f"Device Action error {resp.status_code} for {url} with payload {payload}")
 
     def get_bridge_version(self):
         self.logger.debug(f"get_bridge_version: {self.address}")
         url = f"http://{self.address}/v2/sys/version"
-        resp = requests.get(url, headers=self.token_header)
+        resp = self.request("GET", url)
         resp.raise_for_status()
         return resp.json()
 
     def get_bridge_info(self):
         self.logger.debug(f"get_bridge_info: {self.address}")
         url = f"http://{self.address}/v2/bridge"
-        resp = requests.get(url, headers=self.token_header)
+        resp = self.request("GET", url)
         resp.raise_for_status()
         return resp.json()
 
     def set_bridge_info(self, data):
         self.logger.debug(f"set_bridge_info: {self.address} = {data}")
         url = f"http://{self.address}/v2/bridge"
-        resp = requests.patch(url, headers=self.token_header, json=data)
+        resp = self.request("PATCH", url, data)
         resp.raise_for_status()
         return resp.json()
 
     def get_device_list(self):
-        self.logger.debug(f"get_device_list: {self.address}")
+        if self.debug_enabled:
+            self.logger.debug(f"get_device_list: {self.address}")
         url = f"http://{self.address}/v2/devices"
-        resp = requests.get(url, headers=self.token_header)
+        resp = self.request("GET", url)
         resp.raise_for_status()
-        self.logger.debug(f"get_device_list: {resp.json()}")
+        devices = resp.json()
+        if self.debug_enabled:
+            self.logger.debug(f"get_device_list: {devices}")
         retList = []
-        for key in resp.json():
+        for key in devices:
             if not key.startswith("_"):     # skip internal keys
                 retList.append(key)
         return retList
@@ -125,28 +181,68 @@ class BondHome(object):
     def get_device(self, device_id):
         self.logger.debug(f"get_device: {device_id} @ {self.address}")
         url = f"http://{self.address}/v2/devices/{device_id}"
-        resp = requests.get(url, headers=self.token_header)
+        resp = self.request("GET", url)
         resp.raise_for_status()
         return resp.json()
 
     def get_device_state(self, device_id):
         self.logger.debug(f"get_device_state: {device_id} @ {self.address}")
         url = f"http://{self.address}/v2/devices/{device_id}/state"
-        resp = requests.get(url, headers=self.token_header)
+        resp = self.request("GET", url)
         resp.raise_for_status()
         return resp.json()
 
     def update_device_state(self, device_id, payload):
         self.logger.debug(f"update_device_state: {device_id} @ {self.address}, {payload}")
         url = f"http://{self.address}/v2/devices/{device_id}/state"
-        resp = requests.patch(url, headers=self.token_header, json=payload)
+        resp = self.request("PATCH", url, payload)
         resp.raise_for_status()
         return resp.json()
 
+    # Fetch the current states of device_ids concurrently.  Returns a dict keyed by device_id of the state dict, or a
+    # StateReadError wrapping the exception raised for that device.
+    def get_device_states(self, device_ids):
+        results = {}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {device_id: executor.submit(self.get_device_state, device_id) for device_id in device_ids}
+            for device_id, future in futures.items():
+                try:
+                    results[device_id] = future.result()
+                except Exception as err:
+                    results[device_id] = StateReadError(err)
+        return results
+
+    # snapshot is a dict keyed by device_id of desired state dicts.  Current states are fetched concurrently, then only
+    # the fields that differ are PATCHed, also concurrently.  Returns a dict keyed by device_id of the fields that were
+    # updated, or the exception raised for that device.  Failures reading the current state are wrapped in StateReadError.
+    # Devices already matching the snapshot are not included.
+    def sync_device_states(self, snapshot):
+        self.logger.debug(f"sync_device_states: {len(snapshot)} devices @ {self.address}")
+        results = {}
+        changes = {}
+        for device_id, current in self.get_device_states(snapshot).items():
+            if isinstance(current, StateReadError):
+                results[device_id] = current
+                continue
+            payload = {key: value for key, value in snapshot[device_id].items() if current.get(key) != value}
+            if payload:
+                changes[device_id] = payload
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {device_id: executor.submit(self.update_device_state, device_id, payload) for device_id, payload in changes.items()}
+            for device_id, future in futures.items():
+                try:
+                    future.result()
+                except Exception as err:
+                    results[device_id] = err
+                else:
+                    results[device_id] = changes[device_id]
+        return results
+
     def get_device_command_list(self, device_id):
         self.logger.debug(f"get_device_command_list: {device_id} @ {self.address}")
         url = f"http://{self.address}/v2/devices/{device_id}/commands"
-        resp = requests.get(url, headers=self.token_header)
+        resp = self.request("GET", url)
         resp.raise_for_status()
         retList = []
         for key in resp.json():
@@ -157,14 +253,14 @@ class BondHome(object):
     def get_device_command(self, device_id, command_id):
         self.logger.debug(f"get_device_command: {device_id} @ {self.address}, {command_id}")
         url = f"http://{self.address}/v2/devices/{device_id}/commands/{command_id}"
-        resp = requests.get(url, headers=self.token_header)
+        resp = self.request("GET", url)
         resp.raise_for_status()
         return resp.json()
 
     def set_device_command_signal(self, device_id, command_id, payload):
         self.logger.debug(f"set_device_command_signal: {device_id} @ {self.address}, {command_id}, {payload}")
         url = f"http://{self.address}/v2/devices/{device_id}/commands/{command_id}/signal"
-        resp = requests.patch(url, headers=self.token_header, json=payload)
+        resp = self.request("PATCH", url, payload)
         resp.raise_for_status()
         return resp.json()
 
@@ -172,6 +268,6 @@ class BondHome(object):
         self.logger.debug(f"enable_bpup: {enable} @ {self.address}")
         url = f"http://{self.address}/v2/api/bpup"
         payload = {"broadcast": enable}
-        resp = requests.patch(url, headers=self.token_header, json=payload)
+        resp = self.request("PATCH", url, payload)
         resp.raise_for_status()
         return resp.json()
@@ -5,7 +5,9 @@ import indigo  # noqa
 import logging
 import json
 import socket
-from bondhome import BondHome
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bondhome import BondHome, StateReadError, log_flags
 from zeroconf import IPVersion, ServiceBrowser, ServiceStateChange, Zeroconf
 
 bond_device_types = {
@@ -18,6 +20,73 @@ bond_device_types = {
     'UN': "Unknown Device"
 }
 
+# Mapping of Bond state fields to Indigo states, by bond_type.  Each entry is (Bond field, Indigo state id, value type, label).
+# 'onOffState' is the built-in relay state, all others are added as custom states by getDeviceStateList().
+bond_state_schema = {
+    'CF': [
+        ('power', 'onOffState', "Bool", "Power"),
+        ('speed', 'speed', "Number", "Fan Speed"),
+        ('direction', 'direction', "Number", "Fan Direction"),
+        ('breeze', 'breeze', "Bool", "Breeze Mode"),
+        ('light', 'light', "Bool", "Light"),
+        ('brightness', 'brightness', "Number", "Light Brightness"),
+        ('up_light', 'up_light', "Bool", "Up Light"),
+        ('down_light', 'down_light', "Bool", "Down Light"),
+        ('up_light_brightness', 'up_light_brightness', "Number", "Up Light Brightness"),
+        ('down_light_brightness', 'down_light_brightness', "Number", "Down Light Brightness"),
+        ('timer', 'timer', "Number", "Timer"),
+    ],
+    'FP': [
+        ('power', 'onOffState', "Bool", "Power"),
+        ('flame', 'flame', "Number", "Flame"),
+        ('fpfan_power', 'fpfan_power', "Bool", "Fan Power"),
+        ('fpfan_speed', 'fpfan_speed', "Number", "Fan Speed"),
+        ('light', 'light', "Bool", "Light"),
+        ('brightness', 'brightness', "Number", "Light Brightness"),
+        ('timer', 'timer', "Number", "Timer"),
+    ],
+    'MS': [
+        ('open', 'onOffState', "Bool", "Open"),
+        ('position', 'position', "Number", "Position"),
+        ('light', 'light', "Bool", "Light"),
+    ],
+    'LT': [
+        ('light', 'onOffState', "Bool", "Light"),
+        ('brightness', 'brightness', "Number", "Brightness"),
+        ('timer', 'timer', "Number", "Timer"),
+    ],
+    'BD': [
+        ('power', 'onOffState', "Bool", "Power"),
+        ('timer', 'timer', "Number", "Timer"),
+    ],
+    'GX': [
+        ('power', 'onOffState', "Bool", "Power"),
+        ('timer', 'timer', "Number", "Timer"),
+    ],
+}
+
+state_value_converters = {
+    "Bool": lambda value: bool(value and value[0]) if isinstance(value, list) else bool(value),     # breeze is [mode, mean, var]
+    "Number": lambda value: value,
+}
+
+
+# Build the lookup tables used at runtime from bond_state_schema.  Returns a dict keyed by bond_type, value is a tuple of
+# (custom_states, appliers), where custom_states is a list of (state id, value type, label) for getDeviceStateList()
+# and appliers is a tuple of (Bond field, Indigo state id, converter) for apply_bond_states().
+def compile_state_schema(schema):
+    compiled = {}
+    for bond_type, fields in schema.items():
+        custom_states = [(state_id, value_type, label) for _, state_id, value_type, label in fields if state_id != 'onOffState']
+        appliers = tuple((bond_field, state_id, state_value_converters[value_type]) for bond_field, state_id, value_type, _ in fields)
+        compiled[bond_type] = (custom_states, appliers)
+    return compiled
+
+
+# Convert a Bond state dict to a list for updateStatesOnServer(), skipping any fields not present in states.
+def apply_bond_states(appliers, states):
+    return [{'key': state_id, 'value': convert(states[bond_field])} for bond_field, state_id, convert in appliers if bond_field in states]
+
 
 ################################################################################
 class Plugin(indigo.PluginBase):
@@ -29,6 +98,7 @@ class Plugin(indigo.PluginBase):
         self.logLevel = int(self.pluginPrefs.get("logLevel", logging.INFO))
         self.indigo_log_handler.setLevel(self.logLevel)
         self.logger.debug(f"logLevel = {self.logLevel}")
+        self.debug_enabled, self.threaddebug_enabled = log_flags(self.logLevel)
 
         self.found_devices = {}         # zeroconf discovered devices
 
@@ -36,6 +106,7 @@ class Plugin(indigo.PluginBase):
         self.bond_devices = {}          # dict of "client" devices, keyed by (bond) device_ID, value is Indigo device.id
         self.known_devices = {}         # nested dict of client devices, keyed by BondID then device_ID, value is dict returned by get_device()
         self.deferred_start = []        # devices that need to be started after the bridges are all running
+        self.state_map = compile_state_schema(bond_state_schema)   # keyed by bond_type, value is (custom_states, appliers)
 
     def startup(self):
         self.logger.info("Starting Bond Home")
@@ -51,7 +122,7 @@ class Plugin(indigo.PluginBase):
             if service_type == "_bond._tcp.local." and name not in self.found_devices:
                 ip_addr = ".".join([f"{x}" for x in info.addresses[0]])  # address as string (xx.xx.xx.xx)
                 try:
-                    bridge = BondHome(ip_addr, "")
+                    bridge = BondHome(ip_addr, "", self.logLevel)
                     bridge_version = bridge.get_bridge_version()
                     del bridge
                 except Exception as err:
@@ -70,6 +141,9 @@ class Plugin(indigo.PluginBase):
             self.logLevel = int(valuesDict.get("logLevel", logging.INFO))
             self.indigo_log_handler.setLevel(self.logLevel)
             self.logger.debug(f"logLevel = {self.logLevel}")
+            self.debug_enabled, self.threaddebug_enabled = log_flags(self.logLevel)
+            for bridge in self.bond_bridges.values():
+                bridge.set_log_level(self.logLevel)
 
     def getDeviceConfigUiValues(self, pluginProps, typeId, devId):
         self.logger.debug(f"getDeviceConfigUiValues, typeId = {typeId}, devId = {devId}, pluginProps = {pluginProps}")
@@ -92,7 +166,7 @@ class Plugin(indigo.PluginBase):
             try:
                 # using mDNS name when creating the Bond device causes all operations to be very slow.
                 # So we'll use the IP address instead.
-                bridge = BondHome(socket.gethostbyname(device.pluginProps['address']), device.pluginProps['token'])
+                bridge = BondHome(socket.gethostbyname(device.pluginProps['address']), device.pluginProps['token'], self.logLevel)
             except Exception as err:
                 self.logger.warning(f"{device.name}: BondHome __init__ error: {err}")
                 return
@@ -190,16 +264,14 @@ class Plugin(indigo.PluginBase):
         states = bridge.get_device_state(device.address)
         self.logger.debug(f"{device.name}: Device states: {states}")
         device.stateListOrDisplayStateIdChanged()
+        self.update_device_states(device, bond_type, states)
 
-        if bond_type == 'GX':
-            device.updateStateOnServer(key='onOffState', value=bool(states['power']))
-
-        elif bond_type == 'FP':
-            device.updateStateOnServer(key='onOffState', value=bool(states['power']))
-            device.updateStateOnServer(key='flame', value=states.get('flame', 0))
-
-        elif bond_type == 'MS':
-            device.updateStateOnServer(key='onOffState', value=bool(states['open']))
+    def update_device_states(self, device, bond_type, states):
+        if bond_type not in self.state_map:
+            return
+        stateList = apply_bond_states(self.state_map[bond_type][1], states)
+        if stateList:
+            device.updateStatesOnServer(stateList)
 
     def deviceStopComm(self, device):
         self.logger.info(f"{device.name}: Stopping {device.deviceTypeId} Device {device.id}")
@@ -232,9 +304,13 @@ class Plugin(indigo.PluginBase):
         state_list = indigo.PluginBase.getDeviceStateList(self, device)
 
         # add custom states as needed for bond device type
-        if device.pluginProps.get("bond_type", None) == "FP":
-            flame_state = self.getDeviceStateDictForNumberType("flame", "Flame", "Flame")
-            state_list.append(flame_state)
+        bond_type = device.pluginProps.get("bond_type", None)
+        if bond_type in self.state_map:
+            for state_id, value_type, label in self.state_map[bond_type][0]:
+                if value_type == "Bool":
+                    state_list.append(self.getDeviceStateDictForBoolOnOffType(state_id, label, label))
+                else:
+                    state_list.append(self.getDeviceStateDictForNumberType(state_id, label, label))
 
         return state_list
 
@@ -242,17 +318,21 @@ class Plugin(indigo.PluginBase):
     # Process callback from BondHome devices
     ########################################
 
+    # called for every BPUP packet, so debug messages are only formatted when they will be logged
     def receiveBPUP(self, data):
-        self.logger.debug(f"receiveBPUP: {data}")
+        if self.debug_enabled:
+            self.logger.debug(f"receiveBPUP: {data}")
 
         bridge_id = data.get('B')
-        self.logger.threaddebug(f"Bond Bridge id: {bridge_id}")
+        if self.threaddebug_enabled:
+            self.logger.threaddebug(f"Bond Bridge id: {bridge_id}")
         if not bridge_id:
             self.logger.warning(f"receiveBPUP: no Bond Bridge ID in {data}")
             return
 
         device_id = data.get('id')
-        self.logger.debug(f"Bond Device id: {device_id}")
+        if self.debug_enabled:
+            self.logger.debug(f"Bond Device id: {device_id}")
         if not device_id:
             self.logger.warning(f"receiveBPUP: no Bond device ID in {data}")
             return
@@ -261,23 +341,13 @@ class Plugin(indigo.PluginBase):
         if not device:
             self.logger.warning(f"receiveBPUP: No Indigo device for {device_id}")
             return
-        self.logger.debug(f"{device.name}: Device ID: {device.id}")
+        if self.debug_enabled:
+            self.logger.debug(f"{device.name}: Device ID: {device.id}")
 
         bond_type = device.pluginProps['bond_type']
-        self.logger.threaddebug(f"{device.name}: bond_type: {bond_type}")
-        if bond_type in ['CF', 'GX']:
-            state = data.get('b').get('power')
-            device.updateStateOnServer(key='onOffState', value=bool(state))
-
-        elif bond_type == 'FP':
-            state = data.get('b').get('power')
-            device.updateStateOnServer(key='onOffState', value=bool(state))
-            flame = data.get('b').get('flame')
-            device.updateStateOnServer(key='flame', value=flame)
-
-        elif bond_type == 'MS':
-            state = data.get('b').get('open')
-            device.updateStateOnServer(key='onOffState', value=bool(state))
+        if self.threaddebug_enabled:
+            self.logger.threaddebug(f"{device.name}: bond_type: {bond_type}")
+        self.update_device_states(device, bond_type, data.get('b', {}))
 
     ########################################
     #
@@ -487,7 +557,59 @@ class Plugin(indigo.PluginBase):
         else:
             return
 
-        bridge.update_device_state(pluginAction.props["device"], pluginAction.props["command"], payload)
+        bridge.update_device_state(pluginAction.props["device"], payload)
+
+    def syncStateBeliefsAction(self, pluginAction):
+        self.logger.debug(f"syncStateBeliefsAction, pluginAction = {pluginAction}")
+        try:
+            snapshot = json.loads(indigo.activePlugin.substitute(pluginAction.props["snapshot"]))
+        except ValueError as err:
+            self.logger.warning(f"syncStateBeliefsAction: invalid snapshot: {err}")
+            return
+        self.sync_state_beliefs(snapshot)
+
+    # snapshot is a nested dict keyed by BondID, then device_ID, value is the desired state dict for that device.
+    # Each bridge is synced in its own thread, and each bridge sends its PATCH requests concurrently.
+    def sync_state_beliefs(self, snapshot):
+        if not isinstance(snapshot, dict):
+            self.logger.warning(f"sync_state_beliefs: snapshot is not a JSON object: {snapshot}")
+            return {}
+
+        bridges = {}
+        for bondID, devices in snapshot.items():
+            if bondID not in self.bond_bridges:
+                self.logger.warning(f"sync_state_beliefs: bridge not active: {bondID}")
+                continue
+            if not isinstance(devices, dict):
+                self.logger.warning(f"sync_state_beliefs: devices for bridge {bondID} are not a JSON object: {devices}")
+                continue
+            bridges[bondID] = {}
+            for device_id, states in devices.items():
+                if not isinstance(states, dict):
+                    self.logger.warning(f"sync_state_beliefs: states for {bondID}:{device_id} are not a JSON object: {states}")
+                    continue
+                bridges[bondID][device_id] = states
+
+        if not bridges:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=len(bridges)) as executor:
+            futures = {bondID: executor.submit(self.bond_bridges[bondID].sync_device_states, devices) for bondID, devices in bridges.items()}
+            results = {bondID: future.result() for bondID, future in futures.items()}
+
+        for bondID, bridge_results in results.items():
+            updated = 0
+            for device_id, result in bridge_results.items():
+                name = self.known_devices.get(bondID, {}).get(device_id, {}).get('name', device_id)
+                if isinstance(result, StateReadError):
+                    self.logger.warning(f"sync_state_beliefs: {name} ({bondID}:{device_id}) could not read current state: {result}")
+                elif isinstance(result, Exception):
+                    self.logger.warning(f"sync_state_beliefs: {name} ({bondID}:{device_id}) update failed: {result}")
+                else:
+                    self.logger.debug(f"sync_state_beliefs: {name} ({bondID}:{device_id}) updated: {result}")
+                    updated += 1
+            self.logger.info(f"Bridge {bondID}: updated state beliefs for {updated} of {len(bridges[bondID])} devices")
+        return results
 
     def setCommandRepeatAction(self, pluginAction):
         self.logger.threaddebug(f"setCommandRepeatAction: pluginAction: {pluginAction}")
@@ -527,3 +649,33 @@ class Plugin(indigo.PluginBase):
         self.logger.info(f"\n{json.dumps(self.found_devices, sort_keys=True, indent=4, separators=(',', ': '))}")
         self.logger.info(f"\n{json.dumps(self.known_devices, sort_keys=True, indent=4, separators=(',', ': '))}")
         return True
+
+    def dumpTrace(self):
+        entries = []
+        for bridge in self.bond_bridges.values():
+            entries.extend(bridge.get_trace())
+        entries.sort(key=lambda tup: tup[0])
+        lines = [f"{time.strftime('%H:%M:%S', time.localtime(timestamp))}.{int(timestamp * 1000) % 1000:03d}  {text}" for timestamp, text in entries]
+        self.logger.info(f"Trace of {len(lines)} recent packets and requests:\n" + "\n".join(lines))
+        return True
+
+    def dumpStateSnapshot(self):
+        if not self.bond_bridges:
+            return True
+
+        # read all bridges at once, each bridge reads its device states concurrently
+        with ThreadPoolExecutor(max_workers=len(self.bond_bridges)) as executor:
+            futures = {bondID: executor.submit(bridge.get_device_states, list(self.known_devices.get(bondID, {}))) for bondID, bridge in self.bond_bridges.items()}
+            bridge_states = {bondID: future.result() for bondID, future in futures.items()}
+
+        snapshot = {}
+        for bondID, device_states in bridge_states.items():
+            snapshot[bondID] = {}
+            for device_id, states in device_states.items():
+                if isinstance(states, StateReadError):
+                    self.logger.warning(f"dumpStateSnapshot: could not read current state for {bondID}:{device_id}: {states}")
+                    continue
+                # drop internal keys, they can't be written back
+                snapshot[bondID][device_id] = {key: value for key, value in states.items() if not key.startswith("_")}
+        self.logger.info(f"\n{json.dumps(snapshot, sort_keys=True)}")
+        return True
@@ -0,0 +1,232 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+# plugin.py needs the Indigo runtime, stub it and the plugin's third party imports so it can be imported here
+for module_name in ("indigo", "requests", "zeroconf"):
+    sys.modules.setdefault(module_name, types.ModuleType(module_name))
+indigo_stub = sys.modules["indigo"]
+if not hasattr(indigo_stub, "PluginBase"):
+    indigo_stub.PluginBase = type("PluginBase", (object,), {"getDeviceStateList": lambda self, device: []})
+zeroconf_stub = sys.modules["zeroconf"]
+for attr in ("IPVersion", "ServiceBrowser", "ServiceStateChange", "Zeroconf"):
+    if not hasattr(zeroconf_stub, attr):
+        setattr(zeroconf_stub, attr, object)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "BondHome.indigoPlugin", "Contents", "Server Plugin"))
+import plugin  # noqa: E402
+
+
+class FakeDevice(object):
+    # records the state updates sent to the Indigo server
+    def __init__(self, bond_type=None, bridge="ZZBL1", address="aabbccdd", dev_id=1001):
+        self.id = dev_id
+        self.name = f"Bond {address}"
+        self.deviceTypeId = "bondDevice"
+        self.address = address
+        self.subModel = ""
+        self.pluginProps = {"bridge": bridge}
+        if bond_type:
+            self.pluginProps["bond_type"] = bond_type
+        self.state_updates = []
+
+    def updateStatesOnServer(self, state_list):
+        self.state_updates.append(state_list)
+
+    def stateListOrDisplayStateIdChanged(self):
+        pass
+
+    def replaceOnServer(self):
+        pass
+
+    def replacePluginPropsOnServer(self, props):
+        self.pluginProps = props
+
+
+class FakeBridge(object):
+    def __init__(self, states):
+        self.states = states
+
+    def get_device_state(self, device_id):
+        return self.states[device_id]
+
+
+class FakePlugin(object):
+    # just enough of Plugin for getDeviceStateList(), receiveBPUP() and do_device_startup()
+    getDeviceStateList = plugin.Plugin.getDeviceStateList
+    update_device_states = plugin.Plugin.update_device_states
+    receiveBPUP = plugin.Plugin.receiveBPUP
+    do_device_startup = plugin.Plugin.do_device_startup
+
+    def __init__(self):
+        self.logger = logging.getLogger("Plugin.test")
+        self.debug_enabled = False
+        self.threaddebug_enabled = False
+        self.state_map = plugin.compile_state_schema(plugin.bond_state_schema)
+        self.bond_bridges = {}
+        self.bond_devices = {}
+        self.known_devices = {}
+
+    @staticmethod
+    def getDeviceStateDictForBoolOnOffType(key, trigger_label, control_label):
+        return {"Key": key, "Type": "Bool", "TriggerLabel": trigger_label, "StateLabel": control_label}
+
+    @staticmethod
+    def getDeviceStateDictForNumberType(key, trigger_label, control_label):
+        return {"Key": key, "Type": "Number", "TriggerLabel": trigger_label, "StateLabel": control_label}
+
+
+class StateSchemaTest(unittest.TestCase):
+
+    expected_states = {
+        'CF': [('speed', "Number"), ('direction', "Number"), ('breeze', "Bool"), ('light', "Bool"), ('brightness', "Number"),
+               ('up_light', "Bool"), ('down_light', "Bool"), ('up_light_brightness', "Number"),
+               ('down_light_brightness', "Number"), ('timer', "Number")],
+        'FP': [('flame', "Number"), ('fpfan_power', "Bool"), ('fpfan_speed', "Number"), ('light', "Bool"),
+               ('brightness', "Number"), ('timer', "Number")],
+        'MS': [('position', "Number"), ('light', "Bool")],
+        'LT': [('brightness', "Number"), ('timer', "Number")],
+        'BD': [('timer', "Number")],
+        'GX': [('timer', "Number")],
+    }
+
+    def setUp(self):
+        self.fake_plugin = FakePlugin()
+        self.state_map = self.fake_plugin.state_map
+
+    def apply(self, bond_type, states):
+        return plugin.apply_bond_states(self.state_map[bond_type][1], states)
+
+    def test_all_types_compiled(self):
+        self.assertEqual(set(self.state_map), {'CF', 'FP', 'MS', 'LT', 'BD', 'GX'})
+
+    def test_device_state_list(self):
+        for bond_type, expected in self.expected_states.items():
+            with self.subTest(bond_type=bond_type):
+                state_list = self.fake_plugin.getDeviceStateList(FakeDevice(bond_type))
+                self.assertEqual([(state["Key"], state["Type"]) for state in state_list], expected)
+
+    def test_device_state_list_unknown_type(self):
+        self.assertEqual(self.fake_plugin.getDeviceStateList(FakeDevice('UN')), [])
+
+    def test_apply_cf(self):
+        states = {'power': 1, 'speed': 3, 'direction': -1, 'breeze': [1, 50, 50], 'light': 0, 'brightness': 40, '_': "abcd"}
+        self.assertEqual(self.apply('CF', states), [
+            {'key': 'onOffState', 'value': True},
+            {'key': 'speed', 'value': 3},
+            {'key': 'direction', 'value': -1},
+            {'key': 'breeze', 'value': True},
+            {'key': 'light', 'value': False},
+            {'key': 'brightness', 'value': 40},
+        ])
+
+    def test_apply_cf_breeze_off(self):
+        self.assertEqual(self.apply('CF', {'breeze': [0, 50, 50]}), [{'key': 'breeze', 'value': False}])
+
+    def test_apply_cf_breeze_empty(self):
+        self.assertEqual(self.apply('CF', {'breeze': []}), [{'key': 'breeze', 'value': False}])
+
+    def test_apply_fp(self):
+        self.assertEqual(self.apply('FP', {'power': 0, 'flame': 70, 'fpfan_power': 1, 'fpfan_speed': 2}), [
+            {'key': 'onOffState', 'value': False},
+            {'key': 'flame', 'value': 70},
+            {'key': 'fpfan_power', 'value': True},
+            {'key': 'fpfan_speed', 'value': 2},
+        ])
+
+    def test_apply_ms(self):
+        self.assertEqual(self.apply('MS', {'open': 1, 'position': 20}), [
+            {'key': 'onOffState', 'value': True},
+            {'key': 'position', 'value': 20},
+        ])
+
+    def test_apply_lt(self):
+        self.assertEqual(self.apply('LT', {'light': 1, 'brightness': 80}), [
+            {'key': 'onOffState', 'value': True},
+            {'key': 'brightness', 'value': 80},
+        ])
+
+    def test_apply_bd(self):
+        self.assertEqual(self.apply('BD', {'power': 1, 'timer': 600}), [
+            {'key': 'onOffState', 'value': True},
+            {'key': 'timer', 'value': 600},
+        ])
+
+    def test_apply_gx(self):
+        self.assertEqual(self.apply('GX', {'power': 0}), [{'key': 'onOffState', 'value': False}])
+
+    def test_apply_skips_absent_fields(self):
+        for bond_type in self.expected_states:
+            with self.subTest(bond_type=bond_type):
+                self.assertEqual(self.apply(bond_type, {}), [])
+        self.assertEqual(self.apply('MS', {'position': 50, 'power': 1}), [{'key': 'position', 'value': 50}])
+
+
+
+class DeviceStateUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake_plugin = FakePlugin()
+
+    def receive(self, device, data):
+        self.fake_plugin.bond_devices[f"ZZBL1:{device.address}"] = device.id
+        with mock.patch.object(plugin.indigo, "devices", {device.id: device}, create=True):
+            self.fake_plugin.receiveBPUP(data)
+
+    def test_bpup_one_update_per_packet(self):
+        device = FakeDevice('CF')
+        self.receive(device, {'B': "ZZBL1", 'id': device.address, 'b': {'power': 1, 'speed': 2, 'breeze': [0, 50, 50]}})
+        self.assertEqual(device.state_updates, [[
+            {'key': 'onOffState', 'value': True},
+            {'key': 'speed', 'value': 2},
+            {'key': 'breeze', 'value': False},
+        ]])
+
+    def test_bpup_each_type(self):
+        packets = {
+            'CF': ({'power': 0}, [{'key': 'onOffState', 'value': False}]),
+            'FP': ({'power': 1, 'flame': 30}, [{'key': 'onOffState', 'value': True}, {'key': 'flame', 'value': 30}]),
+            'MS': ({'open': 0, 'position': 100}, [{'key': 'onOffState', 'value': False}, {'key': 'position', 'value': 100}]),
+            'LT': ({'light': 1, 'brightness': 25}, [{'key': 'onOffState', 'value': True}, {'key': 'brightness', 'value': 25}]),
+            'BD': ({'power': 1}, [{'key': 'onOffState', 'value': True}]),
+            'GX': ({'power': 1}, [{'key': 'onOffState', 'value': True}]),
+        }
+        for bond_type, (states, expected) in packets.items():
+            with self.subTest(bond_type=bond_type):
+                device = FakeDevice(bond_type)
+                self.receive(device, {'B': "ZZBL1", 'id': device.address, 'b': states})
+                self.assertEqual(device.state_updates, [expected])
+
+    def test_bpup_no_matching_fields(self):
+        device = FakeDevice('GX')
+        self.receive(device, {'B': "ZZBL1", 'id': device.address, 'b': {'_': "abcd"}})
+        self.assertEqual(device.state_updates, [])
+
+    def test_bpup_unknown_type(self):
+        device = FakeDevice('UN')
+        self.receive(device, {'B': "ZZBL1", 'id': device.address, 'b': {'power': 1}})
+        self.assertEqual(device.state_updates, [])
+
+    def test_startup_cf(self):
+        device = FakeDevice()
+        self.fake_plugin.bond_bridges["ZZBL1"] = FakeBridge({device.address: {'power': 1, 'speed': 3, 'light': 1, 'brightness': 60}})
+        self.fake_plugin.known_devices["ZZBL1"] = {device.address: {'type': 'CF', 'name': "Fan"}}
+        self.fake_plugin.do_device_startup(device)
+        self.assertEqual(device.pluginProps['bond_type'], 'CF')
+        self.assertEqual(device.subModel, "Ceiling Fan")
+        self.assertEqual(device.state_updates, [[
+            {'key': 'onOffState', 'value': True},
+            {'key': 'speed', 'value': 3},
+            {'key': 'light', 'value': True},
+            {'key': 'brightness', 'value': 60},
+        ]])
+
+
+if __name__ == '__main__':
+    unittest.main()